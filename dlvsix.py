@@ -12,21 +12,36 @@ import argparse
 import contextlib
 import functools
 import hashlib
+import hmac
+import http.client
+import inspect
 import io
 import json
 import logging
+import mmap
 import os
+import re
 import shutil
 import subprocess
 import sys
 import tarfile
+import threading
+import time
 import traceback
 import typing as t
+import urllib.error
+import urllib.parse
 import urllib.request
 import zipfile
 from collections.abc import Generator, Iterable
-from concurrent.futures import Future, ThreadPoolExecutor
-from dataclasses import dataclass
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from rich.logging import RichHandler
@@ -39,12 +54,16 @@ from rich.progress import (
     TimeRemainingColumn,
 )
 from rich.progress import Progress as _Progress
-from rich_argparse import RichHelpFormatter
+
+if sys.platform != "win32":
+    import grp
+    import pwd
 
 if t.TYPE_CHECKING:
     P = t.ParamSpec("P")
     Ts = t.TypeVarTuple("Ts")
     R = t.TypeVar("R", covariant=True)
+    V = t.TypeVar("V")
 
 root = Path(__file__).parent.resolve()
 resources = root / "resources"
@@ -74,7 +93,43 @@ TAR_MODES: dict[str | tuple[str, ...], TarFormat] = {
     (".tar",): "",
 }
 TAR_EXTENSIONS = tuple(ext for exts in TAR_MODES for ext in exts)
+# valid extensions for --output-file
+ARCHIVE_EXTENSIONS = (".zip", *TAR_EXTENSIONS)
+
+# files which are already compressed and should be stored as-is in zip archives
+COMPRESSED_EXTENSIONS = (
+    ".vsix",
+    ".zip",
+    *(ext for exts, mode in TAR_MODES.items() if mode for ext in exts),
+)
+
+# multithreaded compressors used instead of the python implementation if available
+TAR_COMPRESSORS: dict[TarFormat, list[str]] = {
+    "gz": ["pigz", "-p", str(os.cpu_count() or 1), "-c"],
+    "xz": ["xz", "-T0", "-c"],
+    "bz2": ["pbzip2", "-c"],
+}
+
+COPY_BUFSIZE = 1024 * 1024
+# larger chunks reduce per-block overhead (crc32, compression, progress) when
+# writing archives
+ARCHIVE_BUFSIZE = 4 * 1024 * 1024
+
+# downloads are network bound, so use more threads than there are cpus.
+# can be changed with --jobs
+DOWNLOAD_WORKERS = min(64, (os.cpu_count() or 1) * 5)
+
+# maximum number of downloads queued on the executor at once, unless there are
+# more workers than this
+MAX_PENDING_TASKS = 64
 
+# number of extensions to request per marketplace query
+MARKETPLACE_QUERY_SIZE = 50
+
+
+TEMPLATE_PATTERN = re.compile(r"\{\{ (\w+) \}\}")
+
+CONTENT_RANGE_PATTERN = re.compile(r"bytes (\d+)-\d+/(?:\d+|\*)")
 
 PRODUCT_JSON_PATH = "resources/app/product.json"
 
@@ -119,6 +174,8 @@ CODE_HOME_PATHS = [
 ]
 
 
+# every logged path is built from the resolved root, so they are already absolute
+# and don't need to be resolved again
 file_log: set[Path] = set()
 
 RESET = "\033[0m"
@@ -146,19 +203,229 @@ class SafeThreadPoolExecutor(ThreadPoolExecutor):
 
 
 class CountingIO(t.IO[bytes]):
+    """Report the number of bytes read to `callback`.
+
+    Updates are batched until at least `threshold` bytes were read, a short read
+    happens (usually the end of the file), or `flush` is called.
+    """
+
+    threshold = 256 * 1024
+
     def __init__(self, raw: t.IO[bytes], callback: t.Callable[[int], None]) -> None:
         self.raw = raw
         self.callback = callback
+        self.pending = 0
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.raw.read(n)
+        self.advance(len(data), n)
+        return data
+
+    def readinto(self, b: bytearray | memoryview) -> int:
+        n = self.raw.readinto(b)
+        self.advance(n, len(b))
+        return n
+
+    def advance(self, n: int, requested: int) -> None:
+        self.pending += n
+        if self.pending >= self.threshold or requested < 0 or n < requested:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.callback(self.pending)
+            self.pending = 0
+        self.raw.flush()
+
+    # t.IO defines these as stubs, so __getattr__ would never be reached
+    def fileno(self) -> int:
+        return self.raw.fileno()
+
+    def tell(self) -> int:
+        return self.raw.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.raw.seek(offset, whence)
+
+    def __getattr__(self, name: str) -> t.Any:
+        return getattr(self.raw, name)
+
+
+class HashingIO(t.IO[bytes]):
+    """Compute the sha256 hash of a stream as it is read."""
+
+    def __init__(self, raw: t.IO[bytes], initial: hashlib._Hash | None = None) -> None:
+        self.raw = raw
+        self.hash = initial or hashlib.sha256()
 
     def read(self, n: int = -1) -> bytes:
         data = self.raw.read(n)
-        self.callback(len(data))
+        self.hash.update(data)
         return data
 
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
     def __getattr__(self, name: str) -> t.Any:
         return getattr(self.raw, name)
 
 
+class PooledResponse(http.client.HTTPResponse):
+    """An HTTP response that remembers if it was closed before its body was read."""
+
+    unread = False
+
+    def close(self) -> None:
+        # a fully read response has already closed its file
+        if self.fp is not None and (self.chunked or self.length != 0):
+            self.unread = True
+        super().close()
+
+
+class ConnectionPool:
+    """Reuse one persistent HTTP connection per host for each thread.
+
+    urllib opens a new connection (and TLS handshake) for every request. Most
+    requests go to the same few hosts, so keep the connections alive instead.
+    Requests that need a proxy are still handled by urllib.
+    """
+
+    max_redirects = 5
+    # temporary server errors are retried with exponential backoff
+    max_retries = 5
+    retry_statuses = (502, 503, 504)
+    backoff_factor = 0.3
+    # a stalled connection must not block a worker forever
+    timeout = 60
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+        self.proxies = urllib.request.getproxies()
+
+    def _connection(
+        self, scheme: str, netloc: str, *, fresh: bool = False
+    ) -> http.client.HTTPConnection:
+        conns: dict[tuple[str, str], http.client.HTTPConnection]
+        conns = self.local.__dict__.setdefault("conns", {})
+        responses: dict[tuple[str, str], PooledResponse]
+        responses = self.local.__dict__.setdefault("responses", {})
+        key = (scheme, netloc)
+
+        # the unread body of the last response is still on the connection, so it
+        # can't be used for another request
+        last = responses.pop(key, None)
+        if last is not None and (last.unread or not last.isclosed()):
+            fresh = True
+
+        if fresh and key in conns:
+            conns.pop(key).close()
+        if key not in conns:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(netloc, timeout=self.timeout)
+            conn.response_class = PooledResponse
+            conns[key] = conn
+        return conns[key]
+
+    def _getresponse(
+        self, conn: http.client.HTTPConnection, key: tuple[str, str]
+    ) -> http.client.HTTPResponse:
+        resp = conn.getresponse()
+        if isinstance(resp, PooledResponse):
+            self.local.responses[key] = resp
+        return resp
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        data: bytes | None,
+        headers: dict[str, str],
+    ) -> http.client.HTTPResponse:
+        parts = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        key = (parts.scheme, parts.netloc)
+        conn = self._connection(*key)
+        reused = conn.sock is not None
+        try:
+            conn.request(method, path, data, headers)
+            return self._getresponse(conn, key)
+        except (http.client.HTTPException, ConnectionError):
+            if not reused:
+                raise
+            # the server closed the idle connection, try again with a new one
+            conn = self._connection(*key, fresh=True)
+            conn.request(method, path, data, headers)
+            return self._getresponse(conn, key)
+
+    def _send(
+        self,
+        method: str,
+        url: str,
+        data: bytes | None,
+        headers: dict[str, str],
+    ) -> http.client.HTTPResponse:
+        for attempt in range(self.max_retries):
+            resp = self._request(method, url, data, headers)
+            if resp.status not in self.retry_statuses:
+                return resp
+            resp.read()
+            delay = self.backoff_factor * 2**attempt
+            log.debug("Got %s for %s, retrying in %.1fs", resp.status, url, delay)
+            time.sleep(delay)
+        return self._request(method, url, data, headers)
+
+    def _needs_proxy(self, url: str) -> bool:
+        scheme, netloc = urllib.parse.urlsplit(url)[:2]
+        return scheme in self.proxies and not urllib.request.proxy_bypass(netloc)
+
+    def urlopen(
+        self,
+        url: str,
+        *,
+        method: str = "GET",
+        data: bytes | None = None,
+        headers: dict[str, str] | None = None,
+    ) -> http.client.HTTPResponse:
+        """Open `url`, raising `urllib.error.HTTPError` for error responses."""
+        headers = headers or {}
+        for _ in range(self.max_redirects + 1):
+            # redirects can lead to a host that needs a proxy, so check every hop
+            if self._needs_proxy(url):
+                # urllib follows any further redirects itself
+                req = urllib.request.Request(
+                    url, data=data, headers=headers, method=method
+                )
+                return urllib.request.urlopen(req, timeout=self.timeout)
+
+            resp = self._send(method, url, data, headers)
+            if resp.status in (301, 302, 303, 307, 308) and "Location" in resp.headers:
+                resp.read()
+                url = urllib.parse.urljoin(url, resp.headers["Location"])
+                if resp.status in (301, 302, 303) and method != "HEAD":
+                    # same as urllib, the request becomes a GET without a body
+                    method, data = "GET", None
+                    headers = {
+                        k: v
+                        for k, v in headers.items()
+                        if k.lower() not in ("content-length", "content-type")
+                    }
+                continue
+            if resp.status >= 400:
+                resp.read()
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.headers, None
+                )
+            return resp
+
+        msg = f"Too many redirects for url: {url}"
+        raise urllib.error.URLError(msg)
+
+
+connections = ConnectionPool()
+
+
 class Progress:
     def __init__(self) -> None:
         self.progress = _Progress(
@@ -202,13 +469,21 @@ class ProgressTask:
         self.progress = progress
         self.task = task
 
-    def urllib_callback(self) -> t.Callable[[int, int, int], None] | None:
-        return lambda blocknum, bs, size: self.progress.update(
-            self.task, completed=blocknum * bs, total=size
-        )
+    def advance(self, n: int) -> None:
+        self.progress.update(self.task, advance=n)
+
+    def wrap_file(self, srcobj: t.IO[bytes], *others: ProgressTask) -> CountingIO:
+        """Wrap `srcobj` to advance this task, and any `others`, as it is read."""
+        if not others:
+            return CountingIO(srcobj, self.advance)
+
+        tasks = (self, *others)
+
+        def advance(n: int) -> None:
+            for task in tasks:
+                task.advance(n)
 
-    def wrap_file(self, srcobj: t.IO[bytes]) -> t.IO[bytes]:
-        return CountingIO(srcobj, lambda n: self.progress.update(self.task, advance=n))
+        return CountingIO(srcobj, advance)
 
 
 class ColorFormatter(logging.Formatter):
@@ -315,7 +590,13 @@ class RemoteExtensionVersion(t.TypedDict):
     targetPlatform: t.NotRequired[str]
 
 
+class RemotePublisher(t.TypedDict):
+    publisherName: str
+
+
 class RemoteExtension(t.TypedDict):
+    extensionName: str
+    publisher: RemotePublisher
     versions: list[RemoteExtensionVersion]
 
 
@@ -324,9 +605,16 @@ class AppError(Exception):
 
 
 def expand_var_paths(paths: list[str]) -> Generator[Path, None, None]:
+    win_paths: dict[str, str] = {}
+    if IS_WSL:
+        # resolve all windows variables with a single cmd.exe call
+        unresolved = [path for path in paths if "%" in path]
+        if unresolved:
+            win_paths = dict(zip(unresolved, resolve_win_interps(unresolved)))
+
     for path in paths:
-        if IS_WSL and "%" in path:
-            path = win_path_to_wsl(resolve_win_interp(path))
+        if path in win_paths:
+            path = win_path_to_wsl(win_paths[path])
 
         path = os.path.expandvars(path)
         path = os.path.expanduser(path)
@@ -344,13 +632,14 @@ def expand_var_paths(paths: list[str]) -> Generator[Path, None, None]:
         yield Path(path)
 
 
-def code_home_paths() -> Generator[Path, None, None]:
+@functools.cache
+def code_home_paths() -> tuple[Path, ...]:
     """Expand environment variables and user home in a path.
 
     This function is aware of WSL and will expand windows environment variables not
-    normally available in WSL.
+    normally available in WSL. The paths are only expanded once.
     """
-    return expand_var_paths(CODE_HOME_PATHS)
+    return tuple(expand_var_paths(CODE_HOME_PATHS))
 
 
 def get_vscode_home() -> Path:
@@ -366,24 +655,35 @@ def get_vscode_home() -> Path:
     raise AppError(msg)
 
 
+@functools.cache
 def resolve_win_interp(args: str) -> str:
     """Resolve windows environment variables through cmd.exe"""
+    return resolve_win_interps([args])[0]
+
+
+def resolve_win_interps(args: list[str]) -> list[str]:
+    """Resolve windows environment variables for multiple strings through a single
+    cmd.exe invocation. Each string is echoed on its own line.
+    """
     root_path = win_path_to_wsl("C:\\")
     # use the full path to cmd in case the user disabled windows interop or modified the
     # PATH
     cmd_path = win_path_to_wsl("C:\\Windows\\System32\\cmd.exe")
-    return subprocess.check_output(
-        [cmd_path, "/c", f"echo {args}"],
+    output = subprocess.check_output(
+        [cmd_path, "/c", "&".join(f"echo {arg}" for arg in args)],
         encoding="utf-8",
         # cmd doesn't like being started with a WSL CWD
         cwd=root_path,
-    ).strip()
+    )
+    return [line.strip() for line in output.splitlines()]
 
 
+@functools.cache
 def get_win_home() -> Path:
     return win_path_to_wsl(resolve_win_interp("%USERPROFILE%"))
 
 
+@functools.cache
 def win_path_to_wsl(path: str) -> Path:
     return Path(
         subprocess.check_output(
@@ -393,6 +693,7 @@ def win_path_to_wsl(path: str) -> Path:
     )
 
 
+@functools.cache
 def wsl_path_to_win(path: str | Path) -> str:
     return subprocess.check_output(
         ["wslpath", "-w", path],
@@ -407,8 +708,9 @@ def is_wsl_windows_mount(path: Path) -> bool:
     return not win_path.startswith(r"\\")
 
 
-def flatpak_paths() -> Generator[Path, None, None]:
-    return expand_var_paths(FLATPAK_PATHS)
+@functools.cache
+def flatpak_paths() -> tuple[Path, ...]:
+    return tuple(expand_var_paths(FLATPAK_PATHS))
 
 
 def get_home(path: Path) -> Path:
@@ -423,6 +725,11 @@ def get_home(path: Path) -> Path:
     return Path.home()
 
 
+@functools.cache
+def signature(fn: t.Callable[..., t.Any]) -> inspect.Signature:
+    return inspect.signature(fn)
+
+
 if t.TYPE_CHECKING:
 
     class ProgressFn(t.Protocol[t.Unpack[Ts]]):
@@ -440,12 +747,25 @@ class App:
     progress: Progress
     executor: ThreadPoolExecutor
     dry_run: bool = False
+    max_pending: int = MAX_PENDING_TASKS
+    pending: set[Future[None]] = field(default_factory=set, repr=False)
 
     @classmethod
     @contextlib.contextmanager
-    def create(cls, *, dry_run: bool = False) -> t.Generator[t.Self]:
-        with Progress() as progress, SafeThreadPoolExecutor(10) as executor:
-            yield cls(progress=progress, executor=executor, dry_run=dry_run)
+    def create(
+        cls, *, dry_run: bool = False, jobs: int = DOWNLOAD_WORKERS
+    ) -> t.Generator[t.Self]:
+        with (
+            Progress() as progress,
+            SafeThreadPoolExecutor(jobs) as executor,
+        ):
+            yield cls(
+                progress=progress,
+                executor=executor,
+                dry_run=dry_run,
+                # keep every worker busy
+                max_pending=max(MAX_PENDING_TASKS, jobs),
+            )
 
     def run_fn(self, fn: ProgressFn[t.Unpack[Ts]], *args: t.Unpack[Ts]) -> None:
         """Execute the provided function `fn` with the given arguments.
@@ -455,9 +775,7 @@ class App:
         with the provided arguments and the `progress` object.
         """
         if self.dry_run:
-            import inspect
-
-            bound = inspect.signature(fn).bind_partial(*args).arguments
+            bound = signature(fn).bind_partial(*args).arguments
             log.info(
                 "%s(%s)",
                 fn.__name__,
@@ -469,7 +787,25 @@ class App:
             fn(*args, progress=self.progress)
 
     def submit(self, fn: ProgressFn[t.Unpack[Ts]], *args: t.Unpack[Ts]) -> Future[None]:
-        return self.executor.submit(self.run_fn, fn, *args)
+        """Submit `fn` to the executor via `run_fn`.
+
+        At most `max_pending` tasks are queued at once. Once the limit is
+        reached, this blocks until one of the pending tasks completes.
+        """
+        return self.submit_task(self.run_fn, fn, *args)
+
+    def submit_task(self, fn: t.Callable[P, None], *args: P.args) -> Future[None]:
+        """Submit `fn` to the executor as-is, with the same limits as `submit`.
+
+        `fn` is run even if `self.dry_run` is True, so it must use `run_fn` for
+        anything that shouldn't happen in a dry run.
+        """
+        if len(self.pending) >= self.max_pending:
+            _, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+
+        fut = self.executor.submit(fn, *args)
+        self.pending.add(fut)
+        return fut
 
 
 @dataclass()
@@ -586,24 +922,27 @@ class Product:
         if not extensions_json.exists():
             return Extensions([])
 
-        data: list[ExtensionData] = json.loads(extensions_json.read_text())
-        data.sort(
-            key=lambda ext: (
-                ext["identifier"]["id"],
-                ext["metadata"]["installedTimestamp"],
-            )
-        )
-
-        # Exclude explicitly ignored extensions
-        data = [
-            ext for ext in data if ext["identifier"]["id"].casefold() not in ignored
-        ]
+        # binary mode lets json detect the encoding without decoding to str first
+        with extensions_json.open("rb") as f:
+            data: list[ExtensionData] = json.load(f)
 
         # extensions can contain duplicates, so only include the most recently installed
         # version.
-        extensions = list({ext["identifier"]["id"]: ext for ext in data}.values())
+        latest: dict[str, ExtensionData] = {}
+        for ext in data:
+            ext_id = ext["identifier"]["id"]
+            if ext_id.casefold() in ignored:
+                # Exclude explicitly ignored extensions
+                continue
+            current = latest.get(ext_id)
+            if (
+                current is None
+                or ext["metadata"]["installedTimestamp"]
+                >= current["metadata"]["installedTimestamp"]
+            ):
+                latest[ext_id] = ext
 
-        return Extensions(extensions)
+        return Extensions(list(latest.values()))
 
 
 REMOTING_EXTENSION_IDS = [
@@ -660,12 +999,37 @@ class Distributions:
         self.product = product
         self.update_url = update_url
 
+        self.futures: list[Future[None]] = []
+        self.purged = False
+
         self.dist_dir = workdir / "dist" / self.product.data["commit"]
         self.dist_dir.mkdir(exist_ok=True, parents=True)
 
+    def purge_old_dists(self) -> None:
+        with os.scandir(self.dist_dir.parent) as it:
+            for entry in it:
+                if entry.is_dir() and entry.name != self.dist_dir.name:
+                    if not self.app.dry_run:
+                        log.info("Removing old dist version %s", entry.name)
+                        shutil.rmtree(entry.path)
+                    else:
+                        log.info("Would remove %s", entry.path)
+
     def download_dist(self, dist: str, dest: Path) -> None:
+        # old versions are only removed once a dist of this version is wanted
+        if not self.purged:
+            self.purge_old_dists()
+            self.purged = True
+
+        # check the cache and query the update api on the executor, so queueing
+        # downloads never waits on the filesystem or network
+        self.futures.append(self.app.submit_task(self.fetch_dist, dist, dest))
+
+    def fetch_dist(self, dist: str, dest: Path) -> None:
+        # downloads are only renamed into place once verified, so an existing file
+        # is always complete
         if dest.exists():
-            file_log.add(dest.resolve())
+            file_log.add(dest)
             return
 
         # Microsoft's update API is basically undocumented
@@ -673,22 +1037,23 @@ class Distributions:
         commit = self.product.data["commit"]
         api_url = f"{self.update_url}/api/versions/commit:{commit}/{dist}/stable"
 
-        with urllib.request.urlopen(api_url) as resp:
+        with connections.urlopen(api_url) as resp:
             data: ApiVersion = json.load(resp)
 
-        self.app.submit(
+        self.app.run_fn(
             download_file,
             data["url"],
             dest,
             data["sha256hash"],
         )
 
-    def download_client(self, target_platform: str) -> None:
-        for file in self.dist_dir.iterdir():
-            if file.is_dir() and file.name != self.product.data["commit"]:
-                log.info("Removing old dist version %s", file)
-                shutil.rmtree(file)
+    def wait(self) -> None:
+        """Wait for every queued dist, raising the first error from the update API."""
+        for fut in as_completed(self.futures):
+            fut.result()
+        self.futures.clear()
 
+    def download_client(self, target_platform: str) -> None:
         if target_platform.startswith("alpine"):
             target_platform = target_platform.replace("alpine", "linux")
 
@@ -731,6 +1096,11 @@ class Distributions:
 
 
 class Marketplace:
+    query_headers: t.ClassVar[dict[str, str]] = {
+        "Content-Type": "application/json",
+        "Accept": "application/json;api-version=3.0-preview.1",
+    }
+
     def __init__(self, app: App, service_url: str) -> None:
         self.app = app
         self.service_url = service_url
@@ -738,42 +1108,49 @@ class Marketplace:
         self.extensions_dir = workdir / "extensions"
         self.extensions_dir.mkdir(exist_ok=True, parents=True)
 
-    def _fetch_extension_data(self, ext_name: str) -> RemoteExtension | None:
+        # downloads submitted for each extension, used to clean up old versions
+        self.downloads: dict[str, tuple[ExtensionData, list[Future[None]]]] = {}
+
+    def _fetch_extensions_data(
+        self, ext_names: list[str]
+    ) -> dict[str, RemoteExtension]:
+        """Query the marketplace for multiple extensions in a single request.
+
+        The results are keyed by the case-folded extension id.
+        """
         criteria = [
-            # filter by extension name
-            {"filterType": 7, "value": ext_name},
             # filter by target
             {"filterType": 8, "value": "Microsoft.VisualStudio.Code"},
+            # filter by extension name
+            *({"filterType": 7, "value": ext_name} for ext_name in ext_names),
         ]
         ext_query_param = {
-            "filters": [{"criteria": criteria}],
+            "filters": [
+                {"criteria": criteria, "pageNumber": 1, "pageSize": len(ext_names)}
+            ],
             # include versions, files
             "flags": 3,
         }
 
-        with urllib.request.urlopen(
-            urllib.request.Request(
-                f"{self.service_url}/extensionquery",
-                method="POST",
-                data=json.dumps(ext_query_param).encode(),
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json;api-version=3.0-preview.1",
-                },
-            )
+        with connections.urlopen(
+            f"{self.service_url}/extensionquery",
+            method="POST",
+            data=json.dumps(ext_query_param, separators=(",", ":")).encode(),
+            headers=self.query_headers,
         ) as response:
             data = json.load(response)
 
-        if not data["results"][0]["extensions"]:
-            return None
-        return data["results"][0]["extensions"][0]
+        results: dict[str, RemoteExtension] = {}
+        for ext in data["results"][0]["extensions"]:
+            ext_id = f"{ext['publisher']['publisherName']}.{ext['extensionName']}"
+            results[ext_id.casefold()] = ext
+        return results
 
     def get_download_extension_urls(
-        self, extension: ExtensionData
+        self, extension: ExtensionData, data: RemoteExtension | None
     ) -> t.Iterable[tuple[str, str]]:
-        ext_name = extension["identifier"]["id"]
-        data = self._fetch_extension_data(ext_name)
         if data is None:
+            ext_name = extension["identifier"]["id"]
             log.warning("Unable to find %s in marketplace. Skipping.", ext_name)
             return {}
 
@@ -794,6 +1171,24 @@ class Marketplace:
 
         return sources.items()
 
+    @functools.cached_property
+    def cached_files(self) -> dict[tuple[str, str], set[str]]:
+        """All previously downloaded extension files by (id, version), listed once."""
+        index: dict[tuple[str, str], set[str]] = {}
+        if not self.extensions_dir.is_dir():
+            return index
+        with os.scandir(self.extensions_dir) as ext_dirs:
+            for ext_dir in ext_dirs:
+                if not ext_dir.is_dir():
+                    continue
+                with os.scandir(ext_dir.path) as vers_dirs:
+                    for vers_dir in vers_dirs:
+                        if vers_dir.is_dir():
+                            index[ext_dir.name, vers_dir.name] = set(
+                                os.listdir(vers_dir.path)
+                            )
+        return index
+
     def is_extension_cached(
         self, extension: ExtensionData, platforms: set[str]
     ) -> bool:
@@ -801,68 +1196,119 @@ class Marketplace:
         vers = extension["version"]
 
         base = self.extensions_dir / name / vers
+        cached = self.cached_files.get((name, vers), set())
 
-        file = base / f"{name}-{vers}.vsix"
-        if file.exists():
-            file_log.add(file.resolve())
+        file = f"{name}-{vers}.vsix"
+        if file in cached:
+            file_log.add(base / file)
             return True
 
         for platform in platforms:
-            file = base / f"{name}-{vers}@{platform}.vsix"
-            if not file.exists():
+            file = f"{name}-{vers}@{platform}.vsix"
+            if file not in cached:
                 return False
-            file_log.add(file.resolve())
+            file_log.add(base / file)
 
         return True
 
     def download_extensions(self, extensions: Extensions, platforms: set[str]) -> None:
-        for ext in extensions.extensions:
-            if self.is_extension_cached(ext, platforms):
+        uncached = [
+            ext
+            for ext in extensions.extensions
+            if not self.is_extension_cached(ext, platforms)
+        ]
+
+        # Query the marketplace in batches on the executor so that downloads can
+        # start as soon as the first batch resolves.
+        queries: dict[Future[dict[str, RemoteExtension]], list[ExtensionData]] = {}
+        for i in range(0, len(uncached), MARKETPLACE_QUERY_SIZE):
+            chunk = uncached[i : i + MARKETPLACE_QUERY_SIZE]
+            fut = self.app.executor.submit(
+                self._fetch_extensions_data,
+                [ext["identifier"]["id"] for ext in chunk],
+            )
+            queries[fut] = chunk
+
+        for fut in as_completed(queries):
+            remote = fut.result()
+            for ext in queries[fut]:
+                data = remote.get(ext["identifier"]["id"].casefold())
+                self.download_extension(ext, data, platforms)
+
+    def download_extension(
+        self, ext: ExtensionData, data: RemoteExtension | None, platforms: set[str]
+    ) -> None:
+        for platform, url in self.get_download_extension_urls(ext, data):
+            if platform != "universal" and platform not in platforms:
                 continue
 
-            for platform, url in self.get_download_extension_urls(ext):
-                if platform != "universal" and platform not in platforms:
-                    continue
+            suffix = ""
+            if platform != "universal":
+                suffix = f"@{platform}"
 
-                suffix = ""
-                if platform != "universal":
-                    suffix = f"@{platform}"
-
-                base = self.extensions_dir / ext["identifier"]["id"] / ext["version"]
-                file = f"{ext['identifier']['id']}-{ext['version']}{suffix}.vsix"
-                fut = self.app.submit(download_file, url, base / file)
-                fut.add_done_callback(
-                    lambda fut, ext=ext: (
-                        fut.cancelled() or self.cleanup_old_extension_versions(ext)
-                    )
-                )
+            base = self.extensions_dir / ext["identifier"]["id"] / ext["version"]
+            file = f"{ext['identifier']['id']}-{ext['version']}{suffix}.vsix"
+            fut = self.app.submit(download_file, url, base / file)
+            _, futures = self.downloads.setdefault(ext["identifier"]["id"], (ext, []))
+            futures.append(fut)
+
+    def cleanup_old_versions(self) -> None:
+        """Remove old versions of every extension that was downloaded.
+
+        This must be called after the downloads have finished.
+        """
+        for ext, futures in self.downloads.values():
+            if not all(fut.cancelled() for fut in futures):
+                self.cleanup_old_extension_versions(ext)
 
     def cleanup_old_extension_versions(self, ext: ExtensionData) -> None:
         ext_dir = self.extensions_dir / ext["identifier"]["id"]
         if not ext_dir.exists():
             return
-        for vers_dir in ext_dir.iterdir():
-            if vers_dir.is_dir() and vers_dir.name != ext["version"]:
-                for old_file in vers_dir.iterdir():
-                    if not self.app.dry_run:
-                        log.info("Removing %s", old_file.name)
-                        old_file.unlink()
-                    else:
-                        log.info("Would remove %s", old_file)
-
+        with os.scandir(ext_dir) as vers_dirs:
+            old_dirs = [
+                entry.path
+                for entry in vers_dirs
+                if entry.is_dir() and entry.name != ext["version"]
+            ]
+        for vers_dir in old_dirs:
+            with os.scandir(vers_dir) as it:
+                old_files = list(it)
+            for old_file in old_files:
                 if not self.app.dry_run:
-                    vers_dir.rmdir()
+                    log.info("Removing %s", old_file.name)
+                    os.unlink(old_file.path)
                 else:
-                    log.info("Would remove %s", vers_dir)
+                    log.info("Would remove %s", old_file.path)
+
+            if not self.app.dry_run:
+                os.rmdir(vers_dir)
+            else:
+                log.info("Would remove %s", vers_dir)
+
+
+def file_hash(filename: Path) -> hashlib._Hash:
+    with filename.open("rb", buffering=0) as f:
+        if sys.version_info >= (3, 11):
+            return hashlib.file_digest(f, "sha256")
+
+        # hash in fixed-size chunks so large archives are never fully loaded in memory
+        h = hashlib.sha256()
+        mv = memoryview(bytearray(COPY_BUFSIZE))
+        while n := f.readinto(mv):
+            h.update(mv[:n])
+        return h
 
 
-def verify_sha256_hash(filename: Path, sha256hash: str) -> bool:
-    log.debug("Verifying hash of %s", filename.name)
-    with filename.open("br") as f:
-        actual_hash = hashlib.sha256(f.read()).hexdigest()
+def file_sha256(filename: Path) -> str:
+    return file_hash(filename).hexdigest()
 
-    if sha256hash != actual_hash:
-        log.error("SHA256 Verify failed for %s!", filename.name)
+
+def check_sha256_hash(
+    filename: Path, sha256hash: str, actual_hash: str, *, name: str | None = None
+) -> bool:
+    if not hmac.compare_digest(sha256hash, actual_hash):
+        log.error("SHA256 Verify failed for %s!", name or filename.name)
         filename.unlink()
         return False
     return True
@@ -880,6 +1326,96 @@ def exc_logger(f: t.Callable[P, R]) -> t.Callable[P, R]:
     return decorator
 
 
+def content_range_start(resp: http.client.HTTPResponse) -> int | None:
+    match = CONTENT_RANGE_PATTERN.fullmatch(resp.headers.get("Content-Range", ""))
+    return None if match is None else int(match[1])
+
+
+def range_validator(resp: http.client.HTTPResponse) -> str | None:
+    # weak etags can't be used with If-Range
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("Last-Modified")
+
+
+def resume_headers(
+    part: Path, validator_file: Path, *, verifiable: bool
+) -> tuple[int, dict[str, str]]:
+    """Get the offset to resume `part` from, and the headers to request it with."""
+    validator = None
+    with contextlib.suppress(FileNotFoundError):
+        validator = validator_file.read_text().strip()
+
+    offset = part.stat().st_size if part.exists() else 0
+    if not offset or not (validator or verifiable):
+        return 0, {}
+    if not validator:
+        return offset, {"Range": f"bytes={offset}-"}
+    return offset, {"Range": f"bytes={offset}-", "If-Range": validator}
+
+
+def download_part(
+    url: str, part: Path, *, progress: Progress, verifiable: bool = False
+) -> str:
+    """Download `url` to `part`, resuming from the end of `part` if it exists.
+
+    A download is only resumed if the server can confirm the file hasn't changed
+    since `part` was started, or if `verifiable` is True and the result will be
+    checked against a known hash. Returns the sha256 hash of the whole file.
+    """
+    validator_file = part.with_name(part.name + ".validator")
+    offset, headers = resume_headers(part, validator_file, verifiable=verifiable)
+    try:
+        resp = connections.urlopen(url, headers=headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        if e.headers.get("Content-Range") == f"bytes */{offset}":
+            # already downloaded, the previous run stopped before renaming it
+            validator_file.unlink(missing_ok=True)
+            return file_sha256(part)
+        # the partial file is larger than the remote file, start again
+        part.unlink()
+        return download_part(url, part, progress=progress, verifiable=verifiable)
+
+    resumed = resp.status == 206
+    if resumed and content_range_start(resp) != offset:
+        # the server sent a different part of the file than was asked for
+        log.debug("Invalid Content-Range for %s, restarting", part.stem)
+        resp.close()
+        part.unlink()
+        return download_part(url, part, progress=progress, verifiable=verifiable)
+
+    if not resumed:
+        # remember which version of the file this is, so an interrupted download
+        # can only be resumed if the file didn't change
+        validator = range_validator(resp)
+        if validator:
+            validator_file.write_text(validator)
+        else:
+            validator_file.unlink(missing_ok=True)
+
+    total = resp.length
+    if resumed and total is not None:
+        total += offset
+    with (
+        resp,
+        progress.task(f"Downloading {part.stem}", total=total) as task,
+        part.open("ab" if resumed else "wb") as f,
+    ):
+        initial = None
+        if resumed:
+            log.debug("Resuming %s from %s", part.stem, bytes_to_human(offset))
+            task.advance(offset)
+            initial = file_hash(part)
+        # hash while downloading so the file doesn't need to be read again
+        srcobj = HashingIO(task.wrap_file(resp), initial)
+        shutil.copyfileobj(srcobj, f, COPY_BUFSIZE)
+    validator_file.unlink(missing_ok=True)
+    return srcobj.hexdigest()
+
+
 @exc_logger
 def download_file(
     url: str,
@@ -888,40 +1424,48 @@ def download_file(
     *,
     progress: Progress,
 ) -> None:
+    # incomplete downloads are kept separately so they can be resumed, and are
+    # never mistaken for a complete file
+    part = dest.with_name(dest.name + ".part")
     try:
         dest.parent.mkdir(exist_ok=True, parents=True)
-        with progress.task(f"Downloading {dest.name}") as task:
-            urllib.request.urlretrieve(url, dest, task.urllib_callback())
+        actual_hash = download_part(
+            url, part, progress=progress, verifiable=bool(sha256hash)
+        )
     except urllib.request.HTTPError as e:
         log.exception("Download failed with status %s for url: %s", e.status, url)
     else:
-        if not sha256hash or verify_sha256_hash(dest, sha256hash):
+        if not sha256hash or check_sha256_hash(
+            part, sha256hash, actual_hash, name=dest.name
+        ):
+            part.replace(dest)
             log.info("Downloaded %s", dest.name)
-            file_log.add(dest.resolve())
+            file_log.add(dest)
 
 
 def copy_resource(src: Path, dest: Path) -> None:
-    shutil.copy(src, dest)
-    file_log.add(dest.resolve())
+    # copyfile uses the platform fast-copy path (e.g. sendfile) and skips chmod
+    shutil.copyfile(src, dest)
+    file_log.add(dest)
 
 
 def copy_template(
     src: Path, dest: Path, /, *, newline: str = os.linesep, **kwargs: str
 ) -> None:
-    data = src.read_text()
+    found: set[str] = set()
+
+    def replace(match: re.Match[str]) -> str:
+        key = match[1]
+        found.add(key)
+        if key not in kwargs:
+            log.warning("Missing key '%s' was found in %s", key, src.name)
+            return match[0]
+        return kwargs[key]
 
-    for key, value in kwargs.items():
-        old_data = data.replace("{{ " + key + " }}", value)
-        if old_data == data:
-            log.warning("Key '%s' was not found in %s", key, src.name)
-        data = old_data
+    data = TEMPLATE_PATTERN.sub(replace, src.read_text())
 
-    start_index = 0
-    while (idx := data.find("{{ ", start_index)) != -1:
-        end = data.find(" }}", idx)
-        start_index = end + 3
-        key = data[idx + 3 : end]
-        log.warning("Missing key '%s' was found in %s", key, src.name)
+    for key in kwargs.keys() - found:
+        log.warning("Key '%s' was not found in %s", key, src.name)
 
     if sys.version_info >= (3, 10):
         dest.write_text(data, newline=newline)
@@ -930,7 +1474,7 @@ def copy_template(
         with dest.open("w", newline=newline) as f:
             f.write(data)
 
-    file_log.add(dest.resolve())
+    file_log.add(dest)
 
 
 def is_linux(platform: str) -> bool:
@@ -953,26 +1497,207 @@ def get_platform_client_download(platform: str) -> str:
     return platform
 
 
-def count_total_bytes(paths: Iterable[Path]) -> int:
-    return sum(path.stat().st_size for path in paths if path.is_file())
-
+def copy_stream(
+    srcobj: t.IO[bytes],
+    destobj: t.IO[bytes],
+    bufsize: int = COPY_BUFSIZE,
+    length: int | None = None,
+) -> None:
+    """Copy a stream through a single reusable buffer.
 
-def create_zip(dest: Path, files: Iterable[Path], *, progress: Progress) -> None:
-    log.info("Preparing zip archive")
+    If `length` is given, exactly that many bytes are copied.
+    """
+    remaining = length
+    with memoryview(bytearray(bufsize)) as mv:
+        while remaining is None or remaining > 0:
+            buf = mv if remaining is None else mv[: min(bufsize, remaining)]
+            n = srcobj.readinto(buf)
+            if not n:
+                break
+            destobj.write(buf[:n])
+            if remaining is not None:
+                remaining -= n
+
+    if remaining:
+        msg = "unexpected end of data"
+        raise EOFError(msg)
+
+
+def mmap_copy(srcobj: CountingIO, destobj: t.BinaryIO, length: int) -> None:
+    """Copy `length` bytes from `srcobj` to `destobj` through a memory map.
+
+    The data is written straight from the page cache, and the crc and compression
+    of zip entries read from the same pages, instead of another buffer.
+    """
+    if not length:
+        # empty files can't be mapped
+        return
     with (
-        progress.task(dest.name, total=count_total_bytes(files)) as zip_task,
-        zipfile.ZipFile(dest, "w", compression=zipfile.ZIP_DEFLATED) as zipf,
+        mmap.mmap(srcobj.fileno(), length, access=mmap.ACCESS_READ) as mm,
+        memoryview(mm) as mv,
     ):
+        for start in range(0, length, ARCHIVE_BUFSIZE):
+            with mv[start : start + ARCHIVE_BUFSIZE] as chunk:
+                destobj.write(chunk)
+                srcobj.advance(len(chunk), len(chunk))
+
+
+def _copy_file_range(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd: int, out_fd: int, offset: int, count: int) -> int:
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+# in-kernel copy functions, in order of preference. copy_file_range can also
+# reflink the data on filesystems which support it (btrfs, xfs)
+KERNEL_COPY_FUNCTIONS = [
+    fn
+    for name, fn in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile))
+    if hasattr(os, name)
+]
+
+
+def kernel_copy(srcobj: CountingIO, destobj: t.BinaryIO, length: int) -> int:
+    """Copy up to `length` bytes from `srcobj` to `destobj` inside the kernel.
+
+    Returns the number of bytes copied. This is less than `length` if no kernel copy
+    is supported for these files, in which case the rest must be copied normally.
+    """
+    copied = 0
+    offset = srcobj.tell()
+    in_fd, out_fd = srcobj.fileno(), destobj.fileno()
+    for copy_range in KERNEL_COPY_FUNCTIONS:
+        try:
+            while copied < length:
+                count = min(ARCHIVE_BUFSIZE, length - copied)
+                n = copy_range(in_fd, out_fd, offset + copied, count)
+                if not n:
+                    break
+                copied += n
+                srcobj.advance(n, n)
+        except OSError:
+            if copied:
+                raise
+            # not supported for these files (e.g. across filesystems on older
+            # kernels, or macOS sendfile requires a socket), try the next one
+            continue
+        break
+
+    # the source file position isn't moved when given an offset
+    srcobj.seek(offset + copied)
+    return copied
+
+
+def add_tar_member(
+    tar: tarfile.TarFile, tarinfo: tarfile.TarInfo, srcobj: CountingIO
+) -> None:
+    """Add a regular file to `tar`.
+
+    This replaces `TarFile.addfile`, copying the file through a single reusable
+    buffer. Uncompressed archives are written directly to the output file, so the
+    file data is copied in the kernel instead of through python.
+    """
+    destobj = tar.fileobj
+    header = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+    destobj.write(header)
+
+    copied = 0
+    if isinstance(destobj, io.BufferedWriter):
+        destobj.flush()
+        copied = kernel_copy(srcobj, destobj, tarinfo.size)
+    if copied < tarinfo.size:
+        copy_stream(srcobj, destobj, ARCHIVE_BUFSIZE, tarinfo.size - copied)
+
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder:
+        destobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    # members are only needed when reading, so unlike addfile they aren't kept
+    tar.offset += len(header) + blocks * tarfile.BLOCKSIZE
+
+
+def is_compressed(file: Path) -> bool:
+    return file.name.lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_ahead(files: Iterable[Path]) -> Generator[tuple[Path, t.BinaryIO]]:
+    """Open files for reading one at a time.
+
+    The next file is opened before the current one is yielded, and the OS is asked
+    to start reading it in the background. Reading the next file from disk then
+    overlaps with archiving the current one without using any extra memory.
+    """
+    current: tuple[Path, t.BinaryIO] | None = None
+    try:
         for file in files:
-            with progress.task("⨽" + file.name, total=file.stat().st_size) as file_task:
-                arcname = str(file.relative_to(root))
-                with file.open("rb") as srcobj, zipf.open(arcname, "w") as destobj:
-                    srcobj = file_task.wrap_file(srcobj)
-                    srcobj = zip_task.wrap_file(srcobj)
-                    shutil.copyfileobj(srcobj, destobj)
+            srcobj = file.open("rb")
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(srcobj.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            if current is not None:
+                yield current
+                current[1].close()
+            current = (file, srcobj)
+
+        if current is not None:
+            yield current
+    finally:
+        if current is not None:
+            current[1].close()
+
+
+class FileStat(t.NamedTuple):
+    """A file to archive, stat'ed once for the readme and the archive headers."""
+
+    path: Path
+    stat: os.stat_result
+
+    def __repr__(self) -> str:
+        # os.stat_result is too noisy for the dry-run summary
+        return f"FileStat({str(self.path)!r}, {bytes_to_human(self.stat.st_size)})"
 
 
-def multidict(d: dict[str | tuple[str, ...], str]) -> dict[str, str]:
+def zipinfo_from_stat(arcname: str, st: os.stat_result) -> zipfile.ZipInfo:
+    """Like `ZipInfo.from_file` for a regular file, without another stat call."""
+    # zip timestamps can't be before 1980
+    date_time = max(time.localtime(st.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.file_size = st.st_size
+    return zinfo
+
+
+def create_zip(dest: Path, files: Iterable[FileStat], *, progress: Progress) -> None:
+    log.info("Preparing zip archive")
+    entries: list[tuple[Path, zipfile.ZipInfo]] = []
+    for file, st in files:
+        zinfo = zipinfo_from_stat(str(file.relative_to(root)), st)
+        if is_compressed(file):
+            # re-compressing archives costs a lot of cpu for no gain
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        entries.append((file, zinfo))
+
+    total = sum(zinfo.file_size for _, zinfo in entries)
+    with (
+        progress.task(dest.name, total=total) as zip_task,
+        dest.open("wb", buffering=output_bufsize(dest)) as zipobj,
+        zipfile.ZipFile(zipobj, "w", compression=zipfile.ZIP_STORED) as zipf,
+    ):
+        for file, zinfo in entries:
+            with (
+                progress.task("⨽" + file.name, total=zinfo.file_size) as file_task,
+                file.open("rb") as srcobj,
+                zipf.open(zinfo, "w") as destobj,
+            ):
+                srcobj = file_task.wrap_file(srcobj, zip_task)
+                mmap_copy(srcobj, destobj, zinfo.file_size)
+                srcobj.flush()
+
+
+def multidict(d: dict[str | tuple[str, ...], V]) -> dict[str, V]:
     return {
         k: v
         for keys, v in d.items()
@@ -980,32 +1705,133 @@ def multidict(d: dict[str | tuple[str, ...], str]) -> dict[str, str]:
     }
 
 
+TAR_MODE_BY_EXTENSION = multidict(TAR_MODES)
+
+
 def get_tar_mode(file: Path) -> TarFormat:
-    for ext in TAR_MODES:
-        if file.name.endswith(ext):
-            return TAR_MODES[ext]
+    # check double extensions (.tar.gz) first, then single extensions (.tgz)
+    for ext in ("".join(file.suffixes[-2:]), file.suffix):
+        mode = TAR_MODE_BY_EXTENSION.get(ext.lower())
+        if mode is not None:
+            return mode
 
     msg = f"Unknown tar extension: {file}"
     raise AssertionError(msg)
 
 
-def create_tar(dest: Path, files: Iterable[Path], *, progress: Progress) -> None:
+def output_bufsize(dest: Path) -> int:
+    """Get the write buffer size for an archive at `dest`.
+
+    This is at least 1 MiB, or the block size of the destination filesystem if it
+    is larger, rounded up to a whole number of tar blocks.
+    """
+    bufsize = COPY_BUFSIZE
+    if hasattr(os, "statvfs"):
+        bufsize = max(bufsize, os.statvfs(dest.parent).f_bsize)
+    return -(-bufsize // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+@contextlib.contextmanager
+def open_tar(dest: Path, mode: TarFormat) -> Generator[tarfile.TarFile]:
+    """Open a tar archive for writing at `dest`.
+
+    If a multithreaded compressor for `mode` is installed, the tar stream is piped
+    through it; otherwise the archive is compressed by tarfile.
+    """
+    with dest.open("wb", buffering=output_bufsize(dest)) as destobj:
+        cmd = TAR_COMPRESSORS.get(mode)
+        if cmd is None or shutil.which(cmd[0]) is None:
+            # plain tar archives stay seekable so members are copied in the kernel,
+            # compressed archives are written once, so stream them linearly
+            with tarfile.open(
+                fileobj=destobj,
+                mode=("w|" if mode else "w:") + mode,
+                bufsize=COPY_BUFSIZE,
+                copybufsize=ARCHIVE_BUFSIZE,
+            ) as tar:
+                yield tar
+            return
+
+        log.debug("Compressing with %s", cmd[0])
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=destobj)
+        assert proc.stdin is not None
+        try:
+            with (
+                proc.stdin,
+                tarfile.open(
+                    fileobj=proc.stdin,
+                    mode="w|",
+                    bufsize=COPY_BUFSIZE,
+                    copybufsize=ARCHIVE_BUFSIZE,
+                ) as tar,
+            ):
+                yield tar
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.wait()
+
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+# archived files almost always share an owner, so only look each one up once
+@functools.cache
+def user_name(uid: int) -> str:
+    if sys.platform == "win32":
+        return ""
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@functools.cache
+def group_name(gid: int) -> str:
+    if sys.platform == "win32":
+        return ""
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def tarinfo_from_stat(arcname: str, st: os.stat_result) -> tarfile.TarInfo:
+    """Like `TarFile.gettarinfo` for a regular file, without another stat call."""
+    tarinfo = tarfile.TarInfo(arcname.replace(os.sep, "/"))
+    tarinfo.mode = st.st_mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.size = st.st_size
+    tarinfo.mtime = st.st_mtime
+    tarinfo.uname = user_name(st.st_uid)
+    tarinfo.gname = group_name(st.st_gid)
+    return tarinfo
+
+
+def create_tar(dest: Path, files: Iterable[FileStat], *, progress: Progress) -> None:
     mode = get_tar_mode(dest)
 
     arch_fmt = f"tar.{mode}".strip(".")
     log.info("Preparing %s archive", arch_fmt)
-    with (
-        progress.task(dest.name, total=count_total_bytes(files)) as tar_task,
-        tarfile.open(dest, "w:" + mode) as tar,
-    ):
-        for file in files:
-            with progress.task("⨽" + file.name, total=file.stat().st_size) as file_task:
-                tarinfo = tar.gettarinfo(file, str(file.relative_to(root)))
-                with file.open("rb") as srcobj:
-                    srcobj = file_task.wrap_file(srcobj)
-                    srcobj = tar_task.wrap_file(srcobj)
+    with open_tar(dest, mode) as tar:
+        members = [
+            (file, tarinfo_from_stat(str(file.relative_to(root)), st))
+            for file, st in files
+        ]
+        # write the largest files first so reading ahead always has work queued
+        tarinfos = dict(sorted(members, key=lambda e: -e[1].size))
+        total = sum(tarinfo.size for tarinfo in tarinfos.values())
+
+        with progress.task(dest.name, total=total) as tar_task:
+            for file, srcobj in open_ahead(tarinfos):
+                tarinfo = tarinfos[file]
+                with progress.task("⨽" + file.name, total=tarinfo.size) as file_task:
+                    srcobj = file_task.wrap_file(srcobj, tar_task)
 
-                    tar.addfile(tarinfo, srcobj)
+                    add_tar_member(tar, tarinfo, srcobj)
+                    srcobj.flush()
 
 
 class Args:
@@ -1022,6 +1848,7 @@ class Args:
     download_dists: bool
     ignored_extensions: list[str]
     dry_run: bool
+    jobs: int
 
     output_file: Path | None
     log_level: str
@@ -1030,7 +1857,35 @@ class Args:
         return f"Args({', '.join(f'{k}={v!r}' for k, v in vars(self).items())})"
 
 
+# defaults for all options, also used as-is when there are no arguments to parse
+ARG_DEFAULTS: dict[str, t.Any] = {
+    "code_home": None,
+    "extensions_dir": None,
+    "marketplace_url": None,
+    "update_url": None,
+    "platform": "win32-x64",
+    "server_platform": "linux-x64",
+    "download_server": None,
+    "download_client": True,
+    "download_dists": True,
+    "ignored_extensions": [],
+    "dry_run": False,
+    "jobs": DOWNLOAD_WORKERS,
+    "output_file": Path("vscode-extensions.zip"),
+    "log_level": "INFO",
+}
+
+
 def parse_args() -> Args:
+    if not sys.argv[1:]:
+        # skip building the parser for the common case
+        args = Args()
+        vars(args).update(ARG_DEFAULTS, ignored_extensions=[])
+        return args
+
+    # rich_argparse is only needed to format help, don't import it on startup
+    from rich_argparse import RichHelpFormatter
+
     parser = argparse.ArgumentParser(
         description="Download Visual Studio Code extensions and installation files",
         formatter_class=RichHelpFormatter,
@@ -1072,21 +1927,18 @@ def parse_args() -> Args:
         "--platform",
         "-p",
         choices=["ALL", *TARGET_PLATFORMS],
-        default="win32-x64",
         help="Client platform, defaults to win32-x64",
     )
     ext_group.add_argument(
         "--server-platform",
         "-s",
         choices=["ALL", *TARGET_PLATFORMS],
-        default="linux-x64",
         help=argparse.SUPPRESS,
     )
     ext_group.add_argument(
         "--no-download-server",
         action="store_false",
         dest="download_server",
-        default=None,
         help="Do not download server regardless of remoting extensions",
     )
     ext_group.add_argument(
@@ -1108,7 +1960,6 @@ def parse_args() -> Args:
         "-i",
         dest="ignored_extensions",
         metavar="EXTENSION_ID",
-        default=[],
         type=str.casefold,
         action="append",
         help=(
@@ -1121,6 +1972,13 @@ def parse_args() -> Args:
         action="store_true",
         help="Do not download anything, only print what would be downloaded",
     )
+    ext_group.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        metavar="N",
+        help=f"Number of parallel downloads, defaults to {DOWNLOAD_WORKERS}",
+    )
     # output options
     output_group = parser.add_argument_group(
         "Output Options",
@@ -1129,7 +1987,6 @@ def parse_args() -> Args:
     output_group.add_argument(
         "--output-file",
         "-o",
-        default="vscode-extensions.zip",
         type=Path,
         help="Name of the archive file. Must be a zip or tar archive",
     )
@@ -1187,29 +2044,30 @@ def parse_args() -> Args:
         help="Set the log level",
         type=str.upper,
     )
-    log_group.set_defaults(log_level="INFO")
+    parser.set_defaults(**ARG_DEFAULTS)
 
     args = parser.parse_args(namespace=Args())
 
-    valid_extensions = (".zip", *TAR_EXTENSIONS)
-
-    if args.output_file and not args.output_file.name.endswith(valid_extensions):
+    if args.output_file and not args.output_file.name.endswith(ARCHIVE_EXTENSIONS):
         parser.error("--output-file must be a zip or tar archive")
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     return args
 
 
-def bytes_to_human(size: float) -> str:
-    _unit = "B"
-    for _unit in ["B", "KB", "MB", "GB", "TB"]:
-        if size < 1024.0:
-            break
-        size /= 1024.0
-    return f"{size:.1f} {_unit}"
+BYTE_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+
+def bytes_to_human(size: int) -> str:
+    # each unit is 10 bits larger than the last
+    idx = min(max(0, (size.bit_length() - 1) // 10), len(BYTE_UNITS) - 1)
+    return f"{size / (1 << (idx * 10)):.1f} {BYTE_UNITS[idx]}"
 
 
 def copy_readme(
-    _files: list[Path],
+    files: Iterable[FileStat],
     *,
     commit: str,
     client_dist: str,
@@ -1226,11 +2084,12 @@ def copy_readme(
         SERVER_HOME=server_home,
     )
 
-    file_sizes = {file: file.stat().st_size for file in sorted(_files)}
+    lines = (
+        f"{bytes_to_human(st.st_size):12}{file.relative_to(workdir)}\n"
+        for file, st in files
+    )
     with outfile.open("a") as f:
-        f.write("\n")
-        for file, size in file_sizes.items():
-            f.write(f"{bytes_to_human(size):12}{file.relative_to(workdir)}\n")
+        f.write("\n" + "".join(lines))
 
 
 def copy_script(src: Path, dest: Path, **kwargs: str) -> None:
@@ -1249,6 +2108,31 @@ def copy_install_script(commit: str, version: str, platform: str) -> None:
     )
 
 
+def download_dists(args: Args, product: Product, extensions: Extensions) -> None:
+    dists = product.distributions(args.update_url)
+    if args.download_client:
+        dists.download_client(args.platform)
+
+    should_download_server = args.download_server
+    if should_download_server is None:
+        should_download_server = extensions.has_remoting_extension()
+
+    if should_download_server:
+        dists.download_server(args.server_platform)
+
+        dists.download_cli(args.server_platform)
+        if args.server_platform == "ALL":
+            log.warning("Server platform is set to ALL, not including install script")
+        else:
+            copy_install_script(
+                product.data["commit"],
+                product.data["version"],
+                args.server_platform,
+            )
+
+    dists.wait()
+
+
 def main() -> None:
     args = parse_args()
 
@@ -1259,7 +2143,7 @@ def main() -> None:
     else:
         platforms = {args.platform, args.server_platform}
 
-    with App.create(dry_run=args.dry_run) as app:
+    with App.create(dry_run=args.dry_run, jobs=args.jobs) as app:
         product = Product.load(app, args.code_home)
 
         ignored = {
@@ -1278,31 +2162,14 @@ def main() -> None:
             )
 
         if args.download_dists:
-            dists = product.distributions(args.update_url)
-            if args.download_client:
-                dists.download_client(args.platform)
-
-            should_download_server = args.download_server
-            if should_download_server is None:
-                should_download_server = extensions.has_remoting_extension()
-
-            if should_download_server:
-                dists.download_server(args.server_platform)
-
-                dists.download_cli(args.server_platform)
-                if args.server_platform == "ALL":
-                    log.warning(
-                        "Server platform is set to ALL, not including install script"
-                    )
-                else:
-                    copy_install_script(
-                        product.data["commit"],
-                        product.data["version"],
-                        args.server_platform,
-                    )
+            download_dists(args, product, extensions)
         app.executor.shutdown()
 
-        files = sorted(file_log)
+        if marketplace:
+            marketplace.cleanup_old_versions()
+
+        # stat each file once, it is reused for the readme and the archive
+        files = [FileStat(file, file.stat()) for file in sorted(file_log)]
 
         # readme must be last because it calculates the file sizes
         copy_readme(
@@ -6,11 +6,15 @@ import contextlib
 import json
 import os
 import platform
+import re
 import shutil
+import struct
 import sys
 import time
 import urllib.parse
 import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import TYPE_CHECKING, Any
@@ -21,6 +25,17 @@ if TYPE_CHECKING:
 
 extension_cache = Path(__file__).parent / "extensions"
 
+# large buffers cut the number of read/write calls when extracting big extensions
+COPY_BUFSIZE = 1024 * 1024
+
+# zlib releases the gil, so entries can be decompressed in parallel
+EXTRACT_WORKERS = min(32, os.cpu_count() or 1)
+# extensions are extracted in separate processes to avoid contending on the gil
+INSTALL_WORKERS = os.cpu_count() or 1
+
+# size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER_SIZE = 30
+
 
 def is_server() -> bool:
     # check if the script is running in the server environment
@@ -58,6 +73,25 @@ xmlns = {
     "d": "http://schemas.microsoft.com/developer/vsx-schema/2011",
 }
 
+EXT_KIND_ID = "Microsoft.VisualStudio.Code.ExtensionKind"
+IDENTITY_XPATH = "Metadata/Identity"
+EXT_KIND_XPATH = f"Metadata/Properties/Property[@Id='{EXT_KIND_ID}']"
+
+
+# only a handful of attributes are needed from the manifest, so they are pulled
+# out with regexes before falling back to building the whole xml tree
+manifest_identity_re = re.compile(rb"<Identity\s([^>]*)>")
+manifest_property_re = re.compile(rb"<Property\s([^>]*)>")
+manifest_attr_re = re.compile(rb'([\w:.-]+)\s*=\s*"([^"]*)"')
+
+
+def manifest_attrs(tag: bytes) -> dict[str, str] | None:
+    # entities need a real xml parser to decode, and anything else that isn't a
+    # double quoted attribute (e.g. single quotes) isn't understood here
+    if b"&" in tag or manifest_attr_re.sub(b"", tag).strip(b" \t\r\n/"):
+        return None
+    return {k.decode(): v.decode() for k, v in manifest_attr_re.findall(tag)}
+
 
 @dataclass()
 class ExtManifest:
@@ -68,16 +102,41 @@ class ExtManifest:
 
     kinds: set[str]
 
+    @classmethod
+    def from_bytes(cls, data: bytes) -> ExtManifest | None:
+        # parse extension manifest, using the xml parser only when needed
+        match = manifest_identity_re.search(data)
+        identity = None if match is None else manifest_attrs(match[1])
+        if identity is None or not {"Publisher", "Id", "Version"} <= identity.keys():
+            return cls.from_etree(ET.fromstring(data))
+
+        kinds: set[str] = set()
+        for match in manifest_property_re.finditer(data):
+            prop = manifest_attrs(match[1])
+            if prop is None:
+                return cls.from_etree(ET.fromstring(data))
+            if prop.get("Id") == EXT_KIND_ID:
+                if "Value" not in prop:
+                    return cls.from_etree(ET.fromstring(data))
+                kinds = set(prop["Value"].split(","))
+                break
+
+        return cls(
+            publisher=identity["Publisher"],
+            id=identity["Id"],
+            version=identity["Version"],
+            platform=identity.get("TargetPlatform"),
+            kinds=kinds,
+        )
+
     @classmethod
     def from_etree(cls, root: ET.Element) -> ExtManifest | None:
         # parse extension manifest from an xml ElementTree
-        identity = root.find("Metadata/Identity", xmlns)
+        identity = root.find(IDENTITY_XPATH, xmlns)
         if identity is None:
             return None
 
-        ext_kind_id = "Microsoft.VisualStudio.Code.ExtensionKind"
-
-        prop = root.find(f"Metadata/Properties/Property[@Id='{ext_kind_id}']", xmlns)
+        prop = root.find(EXT_KIND_XPATH, xmlns)
         return cls(
             publisher=identity.attrib["Publisher"],
             id=identity.attrib["Id"],
@@ -87,6 +146,113 @@ class ExtManifest:
         )
 
 
+def zip_data_offset(z: zipfile.ZipFile, info: zipfile.ZipInfo) -> int | None:
+    # find where the data of a zip entry starts. the local header has its own name
+    # and extra field lengths, which don't always match the central directory
+    assert z.fp is not None
+    header = os.pread(z.fp.fileno(), ZIP_LOCAL_HEADER_SIZE, info.header_offset)
+    if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+        return None
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len
+
+
+def sendfile_entry(z: zipfile.ZipFile, info: zipfile.ZipInfo, target: Path) -> bool:
+    # copy an uncompressed zip entry to target in the kernel with sendfile.
+    # returns False if the entry must be copied normally instead
+    if (
+        not hasattr(os, "sendfile")
+        or not hasattr(os, "pread")
+        or info.compress_type != zipfile.ZIP_STORED
+        or info.flag_bits & 0x1  # encrypted
+    ):
+        return False
+
+    offset = zip_data_offset(z, info)
+    if offset is None:
+        return False
+
+    assert z.fp is not None
+    in_fd = z.fp.fileno()
+    with target.open("wb") as f:
+        copied = 0
+        while copied < info.file_size:
+            try:
+                n = os.sendfile(
+                    f.fileno(), in_fd, offset + copied, info.file_size - copied
+                )
+            except OSError:
+                if copied:
+                    raise
+                # not supported for these files (e.g. macOS requires a socket)
+                return False
+            if not n:
+                msg = f"unexpected end of data in {info.filename}"
+                raise EOFError(msg)
+            copied += n
+
+    # sendfile skips the crc check zipfile does when reading, and vsix files have no
+    # other checksum, so check the copied data is intact
+    if pread_crc32(in_fd, offset, info.file_size) != info.CRC:
+        target.unlink()
+        msg = f"Bad CRC-32 for file {info.filename!r}"
+        raise zipfile.BadZipFile(msg)
+    return True
+
+
+def pread_crc32(fd: int, offset: int, length: int) -> int:
+    # compute the crc32 of part of a file without moving its position
+    crc = 0
+    while length > 0:
+        chunk = os.pread(fd, min(COPY_BUFSIZE, length), offset)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        offset += len(chunk)
+        length -= len(chunk)
+    return crc
+
+
+def extract_entries(vsix: str, entries: list[tuple[zipfile.ZipInfo, Path]]) -> None:
+    # a ZipFile isn't safe to share between threads, so each worker opens its own
+    with zipfile.ZipFile(vsix) as z:
+        for entry, target in entries:
+            extract_entry(z, entry, target)
+
+
+def is_extracted(info: zipfile.ZipInfo, target: Path) -> bool:
+    # assume an entry left behind by an earlier run is complete if the size matches
+    try:
+        return target.stat().st_size == info.file_size
+    except FileNotFoundError:
+        return False
+
+
+def extract_entry(z: zipfile.ZipFile, entry: zipfile.ZipInfo, target: Path) -> None:
+    if is_extracted(entry, target):
+        return
+    try:
+        if not sendfile_entry(z, entry, target):
+            write_entry(z, entry, target)
+    except OSError as e:
+        print(f"{type(e).__name__}: {e}")
+
+
+def write_entry(z: zipfile.ZipFile, info: zipfile.ZipInfo, target: Path) -> None:
+    # chunks are already large, so write them straight to the file descriptor
+    # instead of going through another layer of buffering
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+    fd = os.open(target, flags, 0o666)
+    try:
+        with z.open(info) as f:
+            while chunk := f.read(COPY_BUFSIZE):
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
+
+
 class Extensions:
     def __init__(self, code_home: Path) -> None:
         self.code_home = code_home
@@ -113,132 +279,183 @@ class Extensions:
         # load data from filesystem
         self.obsolete: dict[str, bool] = {}
         with contextlib.suppress(FileNotFoundError):
-            self.obsolete = json.loads(self.obsolete_file.read_text())
+            self.obsolete = json.loads(self.obsolete_file.read_bytes())
 
         self.extensions: list[ExtensionData] = []
         with contextlib.suppress(FileNotFoundError):
-            self.extensions = json.loads(self.extensions_file.read_text())
+            self.extensions = json.loads(self.extensions_file.read_bytes())
+
+        # index the extensions by id, keeping their order
+        self.extensions_by_id: dict[str, list[ExtensionData]] = {}
+        for ext in self.extensions:
+            self.index_extension(ext)
+
+        # the uri of every extension shares this prefix, so only resolve it once
+        uri = urllib.parse.urlparse(self.extensions_dir.resolve().as_uri())
+        self.extensions_scheme = uri.scheme
+        self.extensions_path = uri.path.rstrip("/")
 
         self.obsolete_dirty = False
         self.extensions_dirty = False
         return self
 
-    def __exit__(self, *_: Any) -> None:
-        # save data to filesystem if needed
+    def __exit__(self, exc_type: type[BaseException] | None, *_: Any) -> None:
+        # save data to filesystem if needed. extensions are added before they are
+        # extracted, so nothing is saved if an extraction failed
+        if exc_type is not None:
+            return
+
         if self.obsolete_dirty:
-            self.obsolete_file.write_text(self.json_dumps(self.obsolete))
+            self.write_json(self.obsolete_file, self.obsolete)
 
         if self.extensions_dirty:
-            self.extensions_file.write_text(self.json_dumps(self.extensions))
+            self.write_json(self.extensions_file, self.extensions)
+
+    def write_json(self, path: Path, obj: Any) -> None:
+        # write to a temporary file first, so a crash can't leave it half written
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("wb") as f:
+            f.write(self.json_dumps(obj).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.replace(path)
 
     def get_extension(self, ext_id: str, version: str) -> ExtensionData | None:
         # find extension by id and/or version. obsolete extensions are ignored
-        for ext in self.extensions:
-            if ext["identifier"]["id"].lower() == ext_id and (
-                not self.is_obsolete(ext) or ext["version"] == version
-            ):
+        for ext in self.extensions_by_id.get(ext_id, []):
+            if not self.is_obsolete(ext) or ext["version"] == version:
                 return ext
         return None
 
+    def index_extension(self, ext: ExtensionData) -> None:
+        ext_id = ext["identifier"]["id"].lower()
+        self.extensions_by_id.setdefault(ext_id, []).append(ext)
+
     def is_obsolete(self, ext: ExtensionData) -> bool:
         # check if extension is obsolete
         ext_id = f"{ext['identifier']['id']}-{ext['version']}".lower()
         return self.obsolete.get(ext_id, False)
 
-    def extract_vsix(self, z: zipfile.ZipFile, dest: Path) -> None:
+    @staticmethod
+    def extract_vsix(
+        z: zipfile.ZipFile, dest: Path, workers: int = EXTRACT_WORKERS
+    ) -> None:
         # extract extension to the filesystem.
         # only the subpath "extension" is extracted
         # the file "extension.vsixmanifest" is renamed to ".vsixmanifest"
         # any errors are printed to the console
+        # the manifest is copied last, so it's only present once the rest of the
+        # extension has been extracted
         dest.mkdir(parents=True, exist_ok=True)
+
+        prefix = "extension/"
+        entries = [
+            (info, dest / info.filename[len(prefix) :])
+            for info in z.infolist()
+            if info.filename.startswith(prefix)
+        ]
+
+        # create the directories up front so entries can be extracted in any order.
+        # shallow directories go first, so each one only takes a single mkdir
+        parents = {target.parent for _, target in entries} - {dest}
+        for parent in sorted(parents, key=lambda p: len(p.parts)):
+            parent.mkdir(parents=True, exist_ok=True)
+
+        # split the entries evenly between the workers
+        assert z.filename is not None
+        workers = max(1, min(workers, len(entries)))
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(extract_entries, z.filename, entries[i::workers])
+                for i in range(workers)
+            ]
+            for fut in as_completed(futures):
+                fut.result()
+
         with (
             z.open("extension.vsixmanifest") as f,
             (dest / ".vsixmanifest").open("wb") as f2,
         ):
             shutil.copyfileobj(f, f2)
 
-        for entry in z.namelist():
-            if not entry.startswith("extension/"):
-                continue
-            target = os.path.relpath(entry, "extension")
-            target = dest / target
-            target.parent.mkdir(parents=True, exist_ok=True)
-            try:
-                with z.open(entry) as f, (target).open("wb") as f2:
-                    shutil.copyfileobj(f, f2)
-            except OSError as e:
-                print(f"{type(e).__name__}: {e}")
-
-    def install_extension(self, vsix: Path) -> None:
-        # install extension from a vsix file
+    def prepare_install(self, vsix: Path) -> Path | None:
+        # prepare to install extension from a vsix file
         # the vsixmanifest file is read to get the extension metadata
-        # The extension is extracted if the following conditions are met:
+        # The extension is installed if the following conditions are met:
         # - the platform is unset or matches the current platform
         # - the version is not already installed
         # - if `install_server` is True, the extension kind includes workspace
         #
         # When the extension is installed, the metadata is added to the extensions list
-        # and the previous version is marked as obsolete
+        # and the previous version is marked as obsolete. The directory it must be
+        # extracted to is returned, otherwise None. An extension that was already
+        # extracted by an earlier run is only added to the metadata
 
         with zipfile.ZipFile(vsix) as z:
-            with z.open("extension.vsixmanifest") as f:
-                mft = ExtManifest.from_etree(ET.fromstring(f.read()))
+            manifest = z.getinfo("extension.vsixmanifest")
+            with z.open(manifest) as f:
+                mft = ExtManifest.from_bytes(f.read())
 
-            if mft is None:
-                print(f"warning: Invalid extension manifest for {vsix.name}")
-                return
+        if mft is None:
+            print(f"warning: Invalid extension manifest for {vsix.name}")
+            return None
 
-            if self.is_server and "workspace" not in mft.kinds:
-                return
+        if self.is_server and "workspace" not in mft.kinds:
+            return None
 
-            if mft.platform is None or mft.platform == current_platform:
-                pub = mft.publisher
-                name = mft.id
-                vers = mft.version
+        if mft.platform is None or mft.platform == current_platform:
+            pub = mft.publisher
+            name = mft.id
+            vers = mft.version
 
-                location = f"{pub}.{name}-{vers}".lower()
+            location = f"{pub}.{name}-{vers}".lower()
 
-                installed = self.get_extension(f"{pub}.{name}".lower(), vers)
+            installed = self.get_extension(f"{pub}.{name}".lower(), vers)
 
-                if installed is not None and installed["version"] == vers:
-                    return
+            if installed is not None and installed["version"] == vers:
+                return None
 
-                print(f"Installing extension: {location}")
+            print(f"Installing extension: {location}")
 
-                self.extract_vsix(z, self.extensions_dir / location)
-                self.add_extension(pub, name, vers, location)
+            self.add_extension(pub, name, vers, location)
 
-                if installed is not None:
-                    self.add_obsolete(installed)
+            if installed is not None:
+                self.add_obsolete(installed)
+
+            dest = self.extensions_dir / location
+            if is_extracted(manifest, dest / ".vsixmanifest"):
+                return None
+            return dest
+
+        return None
 
     def add_extension(
         self, publisher: str, name: str, version: str, location: str
     ) -> None:
-        abs_location = self.extensions_dir.resolve() / location
-        scheme, _, path, *__ = urllib.parse.urlparse(abs_location.as_uri())
-
-        self.extensions.append(
-            {
-                "identifier": {
-                    "id": f"{publisher}.{name}".lower(),
-                },
-                "version": version,
-                "location": {
-                    "$mid": 1,
-                    "path": path,
-                    "scheme": scheme,
-                },
-                "relativeLocation": location,
-                "metadata": {
-                    "isApplicationScoped": False,
-                    "isMachineScoped": False,
-                    "isBuiltin": False,
-                    "installedTimestamp": int(time.time()),
-                    "pinned": True,
-                    "source": "vsix",
-                },
-            }
-        )
+        path = f"{self.extensions_path}/{urllib.parse.quote(location)}"
+
+        ext: ExtensionData = {
+            "identifier": {
+                "id": f"{publisher}.{name}".lower(),
+            },
+            "version": version,
+            "location": {
+                "$mid": 1,
+                "path": path,
+                "scheme": self.extensions_scheme,
+            },
+            "relativeLocation": location,
+            "metadata": {
+                "isApplicationScoped": False,
+                "isMachineScoped": False,
+                "isBuiltin": False,
+                "installedTimestamp": int(time.time()),
+                "pinned": True,
+                "source": "vsix",
+            },
+        }
+        self.extensions.append(ext)
+        self.index_extension(ext)
         self.extensions_dirty = True
 
     def add_obsolete(self, ext: ExtensionData) -> None:
@@ -289,8 +506,30 @@ def install_extensions(code_home: Path) -> None:
     print("Installing extensions to:", code_home)
 
     with Extensions(code_home) as exts:
-        for file in extension_cache.rglob("*.vsix"):
-            exts.install_extension(file)
+        installs = [
+            (file, dest)
+            for file in extension_cache.rglob("*.vsix")
+            if (dest := exts.prepare_install(file)) is not None
+        ]
+        if not installs:
+            return
+
+        # every extension is extracted to its own directory, so they can be
+        # extracted in parallel. only this process writes the metadata
+        processes = min(INSTALL_WORKERS, len(installs))
+        threads = max(1, EXTRACT_WORKERS // processes)
+        with ProcessPoolExecutor(processes) as executor:
+            futures = [
+                executor.submit(extract_vsix_file, file, dest, threads)
+                for file, dest in installs
+            ]
+            for fut in as_completed(futures):
+                fut.result()
+
+
+def extract_vsix_file(vsix: Path, dest: Path, workers: int) -> None:
+    with zipfile.ZipFile(vsix) as z:
+        Extensions.extract_vsix(z, dest, workers)
 
 
 if __name__ == "__main__":
@@ -4,7 +4,9 @@ from __future__ import annotations
 import argparse
 import os
 import shutil
+import subprocess
 import sys
+import tarfile
 import tempfile
 from pathlib import Path
 
@@ -21,16 +23,41 @@ DATA_DIST_DIR = DATA_DIR / "dist" / COMMIT
 DATA_CLI_TAR = DATA_DIST_DIR / f"vscode-cli-{PLATFORM}-cli{ext}"
 DATA_SERVER_TAR = DATA_DIST_DIR / f"code-server-{server_platform}-{VERSION}{ext}"
 
+# tarfile copies members 16 KiB at a time by default
+COPY_BUFSIZE = 1024 * 1024
+
 
 def universal_extract(archive: Path, dest: Path) -> None:
     # extract the archive to the destination
     # if it is a tar file, apply the tar filter to copy permissions
+    if archive.suffix == ".zip":
+        shutil.unpack_archive(archive, dest)
+        return
+
     kwargs = {}
     # tarfile filters were added in 3.12 with PEP-706
     # 3.14 will change the default to data, which is safe, but insuffient
-    if sys.version_info >= (3, 12) and archive.suffix != ".zip":
+    if sys.version_info >= (3, 12):
         kwargs["filter"] = "tar"
-    shutil.unpack_archive(archive, dest, **kwargs)
+
+    # gzip is single threaded, so stream the tar through pigz if it's available
+    pigz = shutil.which("pigz")
+    if pigz is not None and archive.name.endswith(".tar.gz"):
+        with subprocess.Popen([pigz, "-dc", archive], stdout=subprocess.PIPE) as proc:
+            assert proc.stdout is not None
+            with tarfile.open(
+                fileobj=proc.stdout,
+                mode="r|",
+                bufsize=COPY_BUFSIZE,
+                copybufsize=COPY_BUFSIZE,
+            ) as tar:
+                tar.extractall(dest, **kwargs)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        return
+
+    with tarfile.open(archive, copybufsize=COPY_BUFSIZE) as tar:
+        tar.extractall(dest, **kwargs)
 
 
 def get_default_install_mode() -> str:
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import importlib.util
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Any
+
+import pytest
+
+SCRIPT = Path(__file__).parent.parent / "resources" / "install-extensions.py"
+
+MANIFEST = """<?xml version="1.0" encoding="utf-8"?>
+<PackageManifest Version="2.0.0"
+  xmlns="http://schemas.microsoft.com/developer/vsx-schema/2011"
+  xmlns:d="http://schemas.microsoft.com/developer/vsx-schema-design/2011">
+  <Metadata>
+    {identity}
+    <Properties>
+      <Property Id="Microsoft.VisualStudio.Code.Engine" Value="^1.90.0" />
+      {kind}
+    </Properties>
+  </Metadata>
+</PackageManifest>
+"""
+
+IDENTITY = (
+    '<Identity Language="en-US" Id="python" Version="2024.1.0" Publisher="ms-python"'
+    ' TargetPlatform="linux-x64"/>'
+)
+KIND_ID = "Microsoft.VisualStudio.Code.ExtensionKind"
+
+
+def load_script() -> ModuleType:
+    # the script isn't a package module, so load it by path. dataclasses need the
+    # module to be registered before it runs
+    spec = importlib.util.spec_from_file_location("install_extensions", SCRIPT)
+    assert spec is not None
+    assert spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+install_extensions = load_script()
+
+
+def parse(fn: Any, data: bytes) -> Any:
+    try:
+        return fn(data)
+    except Exception as e:  # noqa: BLE001
+        return type(e)
+
+
+@pytest.mark.parametrize(
+    ("identity", "kind"),
+    [
+        (IDENTITY, f'<Property Id="{KIND_ID}" Value="workspace,ui" />'),
+        (IDENTITY, f'<Property Value="ui" Id="{KIND_ID}"/>'),
+        (IDENTITY, f"<Property Id='{KIND_ID}' Value='workspace'/>"),
+        (IDENTITY, f'<Property Id="{KIND_ID}" />'),
+        (IDENTITY, ""),
+        (IDENTITY.replace('"ms-python"', "'ms-python'"), ""),
+        (IDENTITY.replace("ms-python", "ms&amp;python"), ""),
+        ("", ""),
+    ],
+)
+def test_from_bytes_matches_from_etree(identity: str, kind: str) -> None:
+    data = MANIFEST.format(identity=identity, kind=kind).encode()
+    manifest = install_extensions.ExtManifest
+
+    expected = parse(
+        lambda d: manifest.from_etree(install_extensions.ET.fromstring(d)), data
+    )
+    assert parse(manifest.from_bytes, data) == expected